@@ -12,14 +12,33 @@ Author:
 import streamlit as st
 import pandas as pd
 import weaviate
+import openai
+import functools
 import logging
 import os
+import threading
+import time
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
-from datetime import datetime
-from typing import Optional
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 
+ISSUE_PROPERTIES = ("title", "url", "labels",
+                    "description", "created_at", "state")
+STRING_PROPERTIES = ("title", "url", "description", "created_at", "state")
+# Queries are paginated server-side and cached per (search mode, query, page), the page after the last shown is prefetched.
+# Cached DataFrames are shared across sessions (no pickling) and must not be modified in place.
+MAX_RESULTS = 100
+PAGE_SIZE = 10
+EMBEDDING_MODEL = "text-embedding-ada-002"
+MONTHS = {f"{i:02d}": month for i, month in enumerate(
+    ("January", "February", "March", "April", "May", "June", "July",
+     "August", "September", "October", "November", "December"), start=1)}
+
+
+@st.cache_data(show_spinner=False)
 def load_environment_vars() -> dict:
     """Load required environment variables. Raise an exception if any are missing."""
 
@@ -42,6 +61,27 @@ def load_environment_vars() -> dict:
     return {"OPENAI_API_KEY": openapi_key, "WEAVIATE_URL": weaviate_url, "WEAVIATE_API_KEY": weaviate_api_key}
 
 
+def issues_as_df(data: Optional[list]) -> pd.DataFrame:
+    """Convert the GitHubIssue objects returned by Weaviate into a DataFrame with Arrow-backed string columns."""
+
+    df = pd.DataFrame(data) if data else pd.DataFrame(columns=ISSUE_PROPERTIES)
+    return df.astype({p: "string[pyarrow]" for p in STRING_PROPERTIES})
+
+
+def run_query(w_client: weaviate.Client, with_search: Callable, offset: int = 0, limit: int = PAGE_SIZE) -> pd.DataFrame:
+    """Run a GitHubIssue query for a range of results, where 'with_search' adds the search operator to the shared query builder."""
+
+    builder = (
+        w_client.query
+        .get("GitHubIssue", list(ISSUE_PROPERTIES))
+        .with_offset(offset)
+        .with_limit(limit)
+    )
+
+    response = with_search(builder).do()
+    return issues_as_df(response["data"]["Get"]["GitHubIssue"])
+
+
 @st.cache_resource(show_spinner=False)
 def weaviate_client(openai_key: str, weaviate_url: str, weaviate_api_key: str):
 
@@ -54,65 +94,159 @@ def weaviate_client(openai_key: str, weaviate_url: str, weaviate_api_key: str):
     return client
 
 
-@st.cache_data
-def query_with_near_text(_w_client: weaviate.Client, query, max_results=10) -> pd.DataFrame:
+@st.cache_data(show_spinner=False, max_entries=1024)
+def embed_query(query: str) -> list:
+    """Generate the vector embedding of the search query with the same model used by the 'text2vec-openai' vectorizer."""
+
+    response = openai.Embedding.create(model=EMBEDDING_MODEL, input=query)
+    return response["data"][0]["embedding"]
+
+
+def query_with_near_text(vector: list, offset=0, limit=PAGE_SIZE) -> pd.DataFrame:
     """
     Search GitHub Issues in Weaviate with Near Text.
-    Weaviate converts the input query into a vector through the inference API (OpenAI) and uses that vector as the basis for a vector search.
+    The input query is converted into a vector through the inference API (OpenAI) and that vector is used as the basis for a vector search.
+    The query vector is computed (and cached) client-side with 'embed_query', so that Weaviate does not call OpenAI on every search.
     """
 
-    response = (
-        _w_client.query
-        .get("GitHubIssue", ["title", "url", "labels", "description", "created_at", "state"])
-        .with_near_text({"concepts": [query]})
-        .with_limit(max_results)
-        .do()
-    )
-
-    data = response["data"]["Get"]["GitHubIssue"]
-    return pd.DataFrame.from_dict(data, orient='columns')
+    return run_query(_W_CLIENT, lambda q: q.with_near_vector({"vector": vector}), offset, limit)
 
 
-@st.cache_data
-def query_with_bm25(_w_client: weaviate.Client, query, max_results=10) -> pd.DataFrame:
+def query_with_bm25(query, offset=0, limit=PAGE_SIZE) -> pd.DataFrame:
     """
     Search GitHub Issues in Weaviate with BM25.
     Keyword (also called a sparse vector search) search that looks for objects that contain the search terms in their properties according to 
     the selected tokenization. The results are scored according to the BM25F function. It is .
     """
 
-    response = (
-        _w_client.query
-        .get("GitHubIssue", ["title", "url", "labels", "description", "created_at", "state"])
-        .with_bm25(query=query)
-        .with_limit(max_results)
-        .with_additional("score")
-        .do()
-    )
-
-    data = response["data"]["Get"]["GitHubIssue"]
-    return pd.DataFrame.from_dict(data, orient='columns')
+    return run_query(_W_CLIENT, lambda q: q.with_bm25(query=query).with_additional("score"), offset, limit)
 
 
-@st.cache_data
-def query_with_hybrid(_w_client: weaviate.Client, query, max_results=10) -> pd.DataFrame:
+def query_with_hybrid(query, offset=0, limit=PAGE_SIZE) -> pd.DataFrame:
     """
     Search GitHub Issues in Weaviate with BM25.
     Keyword (also called a sparse vector search) search that looks for objects that contain the search terms in their properties according to 
     the selected tokenization. The results are scored according to the BM25F function. It is .
     """
 
-    response = (
-        _w_client.query
-        .get("GitHubIssue", ["title", "url", "labels", "description", "created_at", "state"])
-        .with_hybrid(query=query)
-        .with_limit(max_results)
-        .with_additional(["score"])
-        .do()
-    )
+    return run_query(_W_CLIENT, lambda q: q.with_hybrid(query=query).with_additional(["score"]), offset, limit)
+
+
+class PageCache:
+    """
+    Thread-safe LRU cache (with TTL) of result pages, which also tracks the pages being fetched so that they are not fetched twice.
+    Pages are fetched on the query executor threads, which have no ScriptRunContext and must not call Streamlit-cached functions.
+    """
 
-    data = response["data"]["Get"]["GitHubIssue"]
-    return pd.DataFrame.from_dict(data, orient='columns')
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600):
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._ttl = ttl
+
+    def _get(self, key: tuple) -> Optional[pd.DataFrame]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        created_at, df = entry
+        if time.monotonic() - created_at > self._ttl:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return df
+
+    def _put(self, key: tuple, df: pd.DataFrame):
+        self._entries[key] = (time.monotonic(), df)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def fetch(self, key: tuple, pages: Iterable[int], load: Callable[[int, int], pd.DataFrame],
+              executor: ThreadPoolExecutor) -> List[Future]:
+        """
+        Return futures of the result pages of 'key', reusing cached pages and running fetches of the same pages.
+        Missing pages are fetched with a single 'load(offset, limit)' request per contiguous range of pages.
+        """
+
+        futures, runs = [], []
+        with self._lock:
+            for page in pages:
+                future = Future()
+                df = self._get((*key, page))
+                if df is not None:
+                    future.set_result(df)
+                elif (*key, page) in self._in_flight:
+                    future = self._in_flight[(*key, page)]
+                else:
+                    self._in_flight[(*key, page)] = future
+                    if runs and runs[-1][-1][0] == page - 1:
+                        runs[-1].append((page, future))
+                    else:
+                        runs.append([(page, future)])
+                futures.append(future)
+
+            for run in runs:
+                executor.submit(self._load, key, run, load)
+
+        return futures
+
+    def _load(self, key: tuple, run: List[Tuple[int, Future]], load: Callable[[int, int], pd.DataFrame]):
+        try:
+            df = load(run[0][0] * PAGE_SIZE, len(run) * PAGE_SIZE)
+        except Exception as ex:
+            with self._lock:
+                for page, _ in run:
+                    self._in_flight.pop((*key, page), None)
+            for _, future in run:
+                future.set_exception(ex)
+            return
+
+        results = []
+        with self._lock:
+            for i, (page, future) in enumerate(run):
+                page_df = df.iloc[i * PAGE_SIZE:(i + 1) * PAGE_SIZE].reset_index(drop=True)
+                self._put((*key, page), page_df)
+                self._in_flight.pop((*key, page), None)
+                results.append((future, page_df))
+
+        for future, page_df in results:
+            future.set_result(page_df)
+
+
+@st.cache_resource(show_spinner=False)
+def page_cache() -> PageCache:
+    return PageCache()
+
+
+def search(fetch_results: Callable[[int, int], pd.DataFrame], key: tuple, max_results: int) -> Iterator[pd.DataFrame]:
+    """
+    Fetch the first page of results and (concurrently, in a single request) the remaining pages covering 'max_results',
+    yielding the first page as soon as it is ready and then all results.
+    The next page is prefetched in the background so that it is already cached when the user increases 'Max Results'.
+    """
+
+    pages = -(-max_results // PAGE_SIZE)
+    if not pages:
+        yield issues_as_df(None)
+        return
+
+    cache = page_cache()
+    executor = st.session_state.query_executor
+    futures = cache.fetch(key, [0], fetch_results, executor)
+    futures += cache.fetch(key, range(1, pages), fetch_results, executor)
+
+    if pages * PAGE_SIZE < MAX_RESULTS:
+        cache.fetch(key, [pages], fetch_results, executor)
+
+    dfs = [futures[0].result()]
+    yield dfs[0].head(max_results)
+
+    if len(futures) > 1:
+        dfs.extend(future.result() for future in futures[1:])
+        yield pd.concat(dfs, ignore_index=True).head(max_results)
 
 
 def onchange_with_near_text():
@@ -133,17 +267,27 @@ def onchange_with_hybrid():
         st.session_state.with_bm25 = False
 
 
-def format_date(date_string: str) -> Optional[str]:
-    try:
-        date = datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%SZ')
-    except:
-        return None
-    return date.strftime('%d %B %Y')
+def format_dates(dates: pd.Series) -> pd.Series:
+    """Format 'YYYY-MM-DDTHH:MM:SSZ' dates as 'DD Month YYYY' by slicing, without parsing them into datetimes."""
+
+    dates = dates.astype("string[pyarrow]")
+    return dates.str[8:10] + " " + dates.str[5:7].map(MONTHS).astype("string[pyarrow]") + " " + dates.str[0:4]
+
 
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s [%(levelname)s] %(message)s")
 
-env_vars = load_environment_vars()
-w_client = weaviate_client(
-    env_vars["OPENAI_API_KEY"], env_vars["WEAVIATE_URL"], env_vars["WEAVIATE_API_KEY"])
+if "_boot" not in st.session_state:
+    env_vars = load_environment_vars()
+    openai.api_key = env_vars["OPENAI_API_KEY"]
+    st.session_state.w_client = weaviate_client(
+        env_vars["OPENAI_API_KEY"], env_vars["WEAVIATE_URL"], env_vars["WEAVIATE_API_KEY"])
+    # Each session gets its own query threads, so that a long search does not queue other users' searches
+    st.session_state.query_executor = ThreadPoolExecutor(max_workers=4)
+    st.session_state._boot = True
+
+_W_CLIENT = st.session_state.w_client
 
 st.header("🦜 Semantic Search on Langchain Issues 🔍")
 
@@ -164,7 +308,7 @@ with st.sidebar.expander("🔍 SEARCH-RESULTS", expanded=True):
     hybrid_score = st.slider('Hybrid Score (Scaled)',
                              min_value=1.0, max_value=3.0, value=1.1, step=0.05)
     max_results = st.slider('Max Results', min_value=0,
-                            max_value=100, value=10, step=1)
+                            max_value=MAX_RESULTS, value=10, step=1)
 
 with st.sidebar:
     "[![Weaviate Docs](https://img.shields.io/badge/Weaviate%20Docs-gray)](https://weaviate.io/developers/weaviate)"
@@ -174,13 +318,13 @@ query = st.text_input("Search in 'langchain-ai/langchain'", '')
 if query:
     if st.session_state.with_near_text:
         st.subheader("Near Text Search")
-        df = query_with_near_text(w_client, query, max_results)
+        mode, fetch_results = "near_text", functools.partial(query_with_near_text, embed_query(query))
     elif st.session_state.with_bm25:
         st.subheader("BM25 Search")
-        df = query_with_bm25(w_client, query, max_results)
+        mode, fetch_results = "bm25", functools.partial(query_with_bm25, query)
     elif st.session_state.with_hybrid:
         st.subheader("Hybrid Search")
-        df = query_with_hybrid(w_client, query, max_results)
+        mode, fetch_results = "hybrid", functools.partial(query_with_hybrid, query)
     else:
         st.info("ℹ️ Select your preferred Search Mode (Near Text, BM25 or Hybrid)!")
         st.stop()
@@ -189,29 +333,37 @@ if query:
         [f'Issues with "{query}"', "Raw"])
 
     with tab_list:
-        if df is None:
-            st.info("No GitHub Issues found.")
-        else:
-            for i in range(1, len(df)):
-                issue = df.iloc[i]
+        list_placeholder = st.empty()
 
-                if st.session_state.with_bm25:
-                    score = issue["_additional"]["score"]
-                    if float(score) < bm25_score:
-                        break
-                elif st.session_state.with_hybrid:
-                    score = issue["_additional"]["score"]
-                    if float(score) * 100 < hybrid_score:
-                        break
-
-                title = issue["title"]
-                url = issue["url"]
-                createdAt = format_date(issue["created_at"])
+    with tab_raw:
+        raw_placeholder = st.empty()
 
-                st.markdown(f'[{title}]({url}) ({createdAt})')
+    for df in search(fetch_results, (mode, query), max_results):
+        with list_placeholder.container():
+            if df.empty:
+                st.info("No GitHub Issues found.")
+            else:
+                issues = df.assign(created_at_fmt=format_dates(df["created_at"]))
 
-    with tab_raw:
-        if df is None:
-            st.info("No GitHub Issues found.")
-        else:
-            st.dataframe(df, hide_index=True)
+                if st.session_state.with_bm25:
+                    scores = df["_additional"].map(lambda a: float(a["score"]))
+                    issues = issues[(scores >= bm25_score).cummin()]
+                elif st.session_state.with_hybrid:
+                    scores = df["_additional"].map(lambda a: float(a["score"]))
+                    issues = issues[(scores * 100 >= hybrid_score).cummin()]
+
+                st.dataframe(
+                    issues[["title", "url", "created_at_fmt"]],
+                    hide_index=True,
+                    use_container_width=True,
+                    column_config={
+                        "title": st.column_config.TextColumn("Title"),
+                        "url": st.column_config.LinkColumn("URL"),
+                        "created_at_fmt": st.column_config.TextColumn("Created"),
+                    })
+
+        with raw_placeholder.container():
+            if df.empty:
+                st.info("No GitHub Issues found.")
+            else:
+                st.dataframe(df, hide_index=True)
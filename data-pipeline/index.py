@@ -1,9 +1,26 @@
 import pandas as pd
 import weaviate
+import openai
+import tiktoken
 import logging
 import os
+import time
 
 from dotenv import load_dotenv
+from typing import Iterator, Tuple
+
+
+BATCH_NUM_WORKERS = 4
+# New objects are keyed by a uuid derived from the issue url; these properties decide whether an indexed issue changed.
+# Changes to EMBEDDED_PROPERTIES require a new vector, changes to METADATA_PROPERTIES are patched in place.
+EMBEDDED_PROPERTIES = ("title", "description")
+METADATA_PROPERTIES = ("state", "labels")
+CHANGE_PROPERTIES = EMBEDDED_PROPERTIES + METADATA_PROPERTIES
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_MAX_TOKENS = 8191
+EMBEDDING_BATCH_SIZE = 512
+EMBEDDING_BATCH_MAX_TOKENS = 250_000
+EMBEDDING_MAX_RETRIES = 5
 
 
 def load_environment_vars() -> dict:
@@ -28,12 +45,108 @@ def load_environment_vars() -> dict:
     return {"OPENAI_API_KEY": openai_api_key, "WEAVIATE_URL": weaviate_url, "WEAVIATE_API_KEY": weaviate_api_key}
 
 
+def fetch_indexed_issues(client: weaviate.Client) -> dict:
+    """Fetch the indexed GitHub Issues as {url: (id, CHANGE_PROPERTIES values)}, paging with the cursor API."""
+
+    indexed = {}
+    cursor = None
+    while True:
+        query = (
+            client.query
+            .get("GitHubIssue", ["url", *CHANGE_PROPERTIES])
+            .with_additional(["id"])
+            .with_limit(1000)
+        )
+        if cursor is not None:
+            query = query.with_after(cursor)
+
+        objects = query.do()["data"]["Get"]["GitHubIssue"]
+        if not objects:
+            return indexed
+
+        for obj in objects:
+            indexed[obj["url"]] = (obj["_additional"]["id"], tuple(
+                obj.get(c) if obj.get(c) is not None else ([] if c == "labels" else "") for c in CHANGE_PROPERTIES))
+        cursor = objects[-1]["_additional"]["id"]
+
+
+def create_embeddings(inputs: list, openai_api_key: str) -> list:
+    """Request the embeddings of a batch of inputs from OpenAI, retrying with exponential backoff on transient errors."""
+
+    for attempt in range(EMBEDDING_MAX_RETRIES):
+        try:
+            response = openai.Embedding.create(
+                model=EMBEDDING_MODEL, input=inputs, api_key=openai_api_key)
+            return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+        except (openai.error.RateLimitError, openai.error.APIError, openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError, openai.error.Timeout, openai.error.TryAgain) as ex:
+            if attempt == EMBEDDING_MAX_RETRIES - 1:
+                raise
+
+            delay = 2 ** attempt
+            logging.warning(f"OpenAI Error: {ex}, retrying in {delay}s")
+            time.sleep(delay)
+
+
+def embed_issues(issues: list, openai_api_key: str) -> Iterator[Tuple[int, list]]:
+    """
+    Generate the vector embeddings of the issues ('title' and 'description') with batched OpenAI requests.
+    Yields (offset, embeddings) as soon as each batch is embedded, so that it can be imported right away.
+    """
+
+    encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    texts = [f"{issue['title']}\n{issue['description']}" for issue in issues]
+    tokens = [item[:EMBEDDING_MAX_TOKENS]
+              for item in encoding.encode_batch(texts, num_threads=os.cpu_count() or 1, disallowed_special=())]
+
+    chunks, chunk, chunk_tokens = [], [], 0
+    for item in tokens:
+        if chunk and (len(chunk) == EMBEDDING_BATCH_SIZE or chunk_tokens + len(item) > EMBEDDING_BATCH_MAX_TOKENS):
+            chunks.append(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(item)
+        chunk_tokens += len(item)
+    if chunk:
+        chunks.append(chunk)
+
+    offset = 0
+    for i, chunk in enumerate(chunks):
+        logging.info(f"Embedding batch {i + 1}/{len(chunks)} ({len(chunk)} issues)")
+        yield offset, create_embeddings(chunk, openai_api_key)
+        offset += len(chunk)
+
+
+def enable_product_quantization(client: weaviate.Client):
+    """
+    Compress the HNSW vectors with Product Quantization (PQ).
+    PQ codebooks are trained on the imported vectors, so it can only be enabled once the class holds data.
+
+    See: https://weaviate.io/developers/weaviate/configuration/pq-compression
+    """
+
+    vector_index_config = client.schema.get("GitHubIssue")["vectorIndexConfig"]
+    if vector_index_config.get("pq", {}).get("enabled"):
+        return
+
+    logging.info("Enabling Product Quantization on 'GitHubIssue'")
+    client.schema.update_config("GitHubIssue", {
+        "vectorIndexConfig": {
+            "pq": {
+                "enabled": True,
+                "trainingLimit": 100000,
+                "segments": 192,
+                "encoder": {"type": "kmeans"}
+            }
+        }
+    })
+
+
 def index_data(openai_api_key: str, weaviate_url: str, weaviate_api_key: str):
     """Index Data into Weaviate"""
-    file_name = "./data-pipeline/langchain-github-issues-2023-09-18.pkl"
+    file_name = "./data-pipeline/langchain-github-issues-2023-09-18.parquet"
 
     logging.info(f"Loading data from '{file_name}'")
-    df = pd.read_pickle(file_name)
+    df = pd.read_parquet(file_name)
 
     logging.info(f"Initializing Weaviate Client: '{weaviate_url}'")
     client = weaviate.Client(
@@ -41,15 +154,14 @@ def index_data(openai_api_key: str, weaviate_url: str, weaviate_api_key: str):
         auth_client_secret=weaviate.AuthApiKey(api_key=weaviate_api_key),
         additional_headers={"X-OpenAI-Api-Key": openai_api_key})
 
-    logging.info(
-        f"Creating 'GituHubIssue' schema in Weaviate: '{weaviate_url}'")
-    client.schema.delete_class("GitHubIssue")
-
     """
     Weaviate generates vector embeddings at the object level (rather than for individual properties).
     text2vec-* modules  generate vectors from text objects. 
     It vectorizes only properties that use the text data type (unless skipped)
 
+    The vectors of the issues are computed in batches before the import (see 'embed_issues') and supplied with each object,
+    in which case Weaviate does not vectorize them again. The vectorizer is still needed to vectorize Hybrid queries (Near Text queries are embedded client-side by the app).
+
     See: https://weaviate.io/developers/weaviate/config-refs/schema#vectorizer 
     """
 
@@ -57,6 +169,9 @@ def index_data(openai_api_key: str, weaviate_url: str, weaviate_api_key: str):
         "class": "GitHubIssue",
         "description": "This class contains GitHub Issues from the langchain repository.",
         "vectorIndexType": "hnsw",
+        "vectorIndexConfig": {
+            "distance": "cosine"
+        },
         "vectorizer": "text2vec-openai",
         "moduleConfig": {
             "text2vec-openai": {
@@ -81,6 +196,10 @@ def index_data(openai_api_key: str, weaviate_url: str, weaviate_api_key: str):
                 "name": "description",
                 "dataType": ["text"]
             },
+            {
+                "name": "labels",
+                "dataType": ["text[]"]
+            },
             {
                 "name": "creator",
                 "dataType": ["text"],
@@ -95,31 +214,80 @@ def index_data(openai_api_key: str, weaviate_url: str, weaviate_api_key: str):
             },
         ]
     }
-    client.schema.create_class(class_obj)
+    if not client.schema.exists("GitHubIssue"):
+        logging.info(
+            f"Creating 'GitHubIssue' schema in Weaviate: '{weaviate_url}'")
+        client.schema.create_class(class_obj)
 
     logging.info(f"Importing data to Weaviate: '{weaviate_url}'")
 
+    text_columns = ("title", "url", "description", "creator", "state")
+    columns = {c: df[c].fillna("").astype(str).tolist() for c in text_columns}
+    columns["labels"] = [list(x) if x is not None else []
+                         for x in df["labels"].tolist()]
+    columns["created_at"] = df["created_at"].tolist()
+
+    issues = [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    indexed = fetch_indexed_issues(client)
+
+    # Issues closed or removed since the last snapshot are no longer fetched, so they are deleted from the index
+    snapshot_urls = set(columns["url"])
+    stale = [uuid for url, (uuid, _) in indexed.items() if url not in snapshot_urls]
+    logging.info(f"Deleting {len(stale)} objects no longer in the snapshot")
+    for uuid in stale:
+        client.data_object.delete(uuid, class_name="GitHubIssue")
+
+    n_embedded = len(EMBEDDED_PROPERTIES)
+    upserts, updates = [], []
+    for properties in issues:
+        uuid, values = indexed.get(properties["url"], (None, None))
+        current = tuple(properties[c] for c in CHANGE_PROPERTIES)
+        if values is None or values[:n_embedded] != current[:n_embedded]:
+            # Changed issues keep the id they are indexed with, so that they are replaced rather than duplicated
+            upserts.append((properties, uuid or weaviate.util.generate_uuid5(properties["url"])))
+        elif values != current:
+            updates.append((properties, uuid))
+
+    logging.info(
+        f"Upserting {len(upserts)} new or changed objects, updating {len(updates)} objects, "
+        f"deleted {len(stale)} stale objects ({len(indexed)} indexed)")
+
+    for properties, uuid in updates:
+        # The current vector is passed along, otherwise Weaviate would re-vectorize the patched object
+        vector = client.data_object.get_by_id(
+            uuid, class_name="GitHubIssue", with_vector=True)["vector"]
+        client.data_object.update(
+            {c: properties[c] for c in METADATA_PROPERTIES}, "GitHubIssue", uuid, vector=vector)
+
+    issues = [properties for properties, _ in upserts]
+    uuids = [uuid for _, uuid in upserts]
+
+    client.batch.configure(
+        batch_size=100,
+        num_workers=BATCH_NUM_WORKERS,
+        dynamic=True,
+        timeout_retries=3,
+        callback=weaviate.util.check_batch_result)
+
     try:
         with client.batch as batch:
-            batch.batch_size = 100
-            for item in df.itertuples():
-                properties = {
-                    "title": item.title,
-                    "url": item.url,
-                    "labels": item.labels,
-                    "description": item.description,
-                    "creator": item.creator,
-                    "created_at": item.created_at,
-                    "state": item.state,
-                }
-
-                batch.add_data_object(
-                    data_object=properties,
-                    class_name="GitHubIssue")
+            for offset, embeddings in embed_issues(issues, openai_api_key):
+                for properties, uuid, vector in zip(issues[offset:], uuids[offset:], embeddings):
+                    batch.add_data_object(
+                        data_object=properties,
+                        class_name="GitHubIssue",
+                        uuid=uuid,
+                        vector=vector)
     except Exception as ex:
         logging.error(f"Unexpected Error: {ex}")
         raise
 
+    logging.info(
+        f"Imported {len(issues)} objects, batch creation time: {client.batch.creation_time:.2f}s")
+
+    enable_product_quantization(client)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO,
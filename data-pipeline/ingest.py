@@ -1,14 +1,19 @@
 import pandas as pd
+import asyncio
+import httpx
 import os
 import logging
+import time
 
-from langchain.document_loaders import GitHubIssuesLoader
 from dotenv import load_dotenv
 
 
 GITHUB_REPOSITORY = "langchain-ai/langchain"
 GITHUB_LABEL = "langchain"
 STORE_PATH = "data-pipeline"
+GITHUB_API_URL = "https://api.github.com"
+ISSUES_PER_PAGE = 100
+MAX_CONCURRENT_REQUESTS = 10
 
 
 def load_environment_vars() -> dict:
@@ -25,43 +30,83 @@ def load_environment_vars() -> dict:
     return {"GITHUB_TOKEN": github_token}
 
 
-def initialize_github_loader(repo: str) -> GitHubIssuesLoader:
-    """Init GitHubIssuesLoader."""
+def issue_as_record(issue: dict) -> dict:
+    """Flatten a GitHub REST API issue into a DataFrame row."""
 
-    logging.info(f"Initializing GitHubIssuesLoader for repo: {repo}")
-    loader = GitHubIssuesLoader(
-        repo=repo,
-        include_prs=False,
-    )
-    return loader
+    return {
+        "description": issue["body"] if issue["body"] is not None else "",
+        "url": issue["html_url"],
+        "title": issue["title"],
+        "creator": issue["user"]["login"],
+        "created_at": issue["created_at"],
+        "comments": issue["comments"],
+        "state": issue["state"],
+        "labels": [label["name"] for label in issue["labels"]],
+        "assignee": issue["assignee"]["login"] if issue["assignee"] else None,
+        "milestone": issue["milestone"]["title"] if issue["milestone"] else None,
+        "locked": issue["locked"],
+        "number": issue["number"],
+        "is_pull_request": "pull_request" in issue,
+    }
 
 
-def fetch_as_df(loader: GitHubIssuesLoader) -> pd.DataFrame:
-    """Fetch Data from GitHub Repository"""
+async def fetch_issues(repo: str, token: str) -> list:
+    """Fetch all issue pages from a GitHub Repository concurrently"""
+
+    url = f"{GITHUB_API_URL}/repos/{repo}/issues"
+    headers = {"Authorization": f"token {token}",
+               "Accept": "application/vnd.github+json"}
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async with httpx.AsyncClient(headers=headers, timeout=30) as client:
+
+        async def fetch_page(page: int) -> httpx.Response:
+            async with semaphore:
+                while True:
+                    response = await client.get(url, params={"per_page": ISSUES_PER_PAGE, "page": page})
+                    if response.status_code in (403, 429) and (
+                            "retry-after" in response.headers or response.headers.get("x-ratelimit-remaining") == "0"):
+                        delay = float(response.headers.get("retry-after", max(
+                            0, int(response.headers.get("x-ratelimit-reset", 0)) - time.time())))
+                        logging.warning(f"GitHub rate limit reached, retrying page {page} in {delay:.0f}s")
+                        await asyncio.sleep(delay)
+                        continue
+
+                    response.raise_for_status()
+                    return response
 
-    logging.info(f"Fetching 'issues' from Github: '{loader.repo}'")
-    docs = loader.load()
+        first = await fetch_page(1)
+        last_page = int(httpx.URL(first.links["last"]["url"]).params["page"]) if "last" in first.links else 1
+
+        logging.info(f"Fetching {last_page} pages of 'issues' from Github: '{repo}'")
+        pages = await asyncio.gather(*(fetch_page(page) for page in range(2, last_page + 1)))
+
+    return [issue for page in (first, *pages) for issue in page.json()]
+
+
+def fetch_as_df(repo: str, token: str) -> pd.DataFrame:
+    """Fetch Data from GitHub Repository"""
 
-    df = pd.DataFrame()
-    for doc in docs:
-        description = doc.page_content
-        metadata = doc.metadata
+    logging.info(f"Fetching 'issues' from Github: '{repo}'")
+    issues = asyncio.run(fetch_issues(repo, token))
 
-        row = pd.DataFrame([{'description': description, **metadata}])
-        df = pd.concat([df, row], ignore_index=True)
+    # Pages are fetched concurrently by number, so issues opened during the crawl shift the pages and repeat rows
+    df = pd.DataFrame.from_records(
+        [issue_as_record(issue) for issue in issues if "pull_request" not in issue])
+    df = df.drop_duplicates("number", ignore_index=True)
 
-    logging.info(f"Fetched {len(df)} 'issues' from Github: '{loader.repo}'")
+    logging.info(f"Fetched {len(df)} 'issues' from Github: '{repo}'")
     logging.info(f"Dataframe Columns: {df.columns}")
 
     return df
 
 
-def store_as_pickle(df: pd.DataFrame, label: str, path: str):
-    """Store DataFrame as json to local file system"""
-    file_name = f"{label}-github-issues-{pd.Timestamp.today().strftime('%Y-%m-%d')}.pkl"
+def store_as_parquet(df: pd.DataFrame, label: str, path: str):
+    """Store DataFrame as parquet to local file system"""
+    file_name = f"{label}-github-issues-{pd.Timestamp.today().strftime('%Y-%m-%d')}.parquet"
 
     logging.info(f"Storing 'issues' to '{path}/{file_name}'")
-    df.to_pickle(f"{path}/{file_name}")
+    df.to_parquet(f"{path}/{file_name}", compression='zstd', index=False)
 
 
 if __name__ == "__main__":
@@ -71,9 +116,8 @@ if __name__ == "__main__":
     try:
         env_vars = load_environment_vars()
 
-        loader = initialize_github_loader(GITHUB_REPOSITORY)
-        df = fetch_as_df(loader)
-        store_as_pickle(df, label=GITHUB_LABEL, path=STORE_PATH)
+        df = fetch_as_df(GITHUB_REPOSITORY, env_vars["GITHUB_TOKEN"])
+        store_as_parquet(df, label=GITHUB_LABEL, path=STORE_PATH)
     except EnvironmentError as ee:
         logging.error(f"Environment Error: {ee}")
         raise